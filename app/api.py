@@ -1,14 +1,17 @@
 import os
 import io
-import json
 import logging
+import asyncio
 import uuid
-import base64 # Import base64 for encoding file content
 from typing import Optional, Dict
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile, HTTPException, status, Path
+from fastapi import FastAPI, File, UploadFile, HTTPException, Response, WebSocket, WebSocketDisconnect, status, Path
 from pydantic import BaseModel
 import redis
+from redis.asyncio import Redis as AsyncRedis
+import orjson
+import msgspec
+import zstandard
 
 # --- Configuration & Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,22 +20,35 @@ load_dotenv()
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = 6379
 REDIS_DB = 0
+TASK_QUEUE_KEY = "queue:pending"
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE_MB", 20)) * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 1024 * 1024 # Read uploads in 1 MiB chunks
+FINAL_TASK_STATUSES = (b"COMPLETED", b"FAILED")
+ZSTD_LEVEL = 3 # Fast compression for stored file content
+
+# Only used from the event loop thread, so a single reusable context is safe
+zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
 
 # --- Redis Connection ---
 try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
+    # Values are kept as bytes end-to-end; JSON and file content need no UTF-8 round trip
+    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False)
     redis_client.ping()
     logging.info(f"Successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
 except redis.exceptions.ConnectionError as e:
     logging.error(f"Failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}: {e}")
     redis_client = None
 
+# Async client for pub/sub status updates (connects lazily on first use)
+async_redis_client = AsyncRedis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False)
+
 # --- Pydantic Models ---
 try:
-    from schema import GeneralizedInvoiceData
+    from schema import GeneralizedInvoiceData, TaskRecord
 except ImportError:
-    logging.error("Could not import GeneralizedInvoiceData from schema.py.")
+    logging.error("Could not import GeneralizedInvoiceData or TaskRecord from schema.py.")
     class GeneralizedInvoiceData(BaseModel): pass # Dummy
+    class TaskRecord: pass # Dummy
 
 class TaskCreationResponse(BaseModel):
     task_id: str
@@ -43,6 +59,25 @@ class TaskStatus(BaseModel):
     result: Optional[Dict] = None
     error: Optional[str] = None
 
+# --- Helper Functions ---
+def build_task_status_body(task_status: bytes, result_json: Optional[bytes], error: Optional[bytes]) -> bytes:
+    """Builds the JSON task status body from the raw fields of a task's Redis hash."""
+    # The result is already stored as JSON, so splice it into the body as-is
+    # instead of decoding it and having FastAPI re-serialize a TaskStatus.
+    # Status values are plain ASCII words; only the free-form error needs escaping.
+    return b'{"status":"%b","result":%b,"error":%b}' % (
+        task_status,
+        result_json or b"null",
+        orjson.dumps(error.decode()) if error else b"null",
+    )
+
+async def wait_for_disconnect(websocket: WebSocket):
+    """Reads from a status WebSocket until the client disconnects; clients send nothing else."""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
 # --- FastAPI App Initialization ---
 app = FastAPI(
     title="Invoice Extractor API",
@@ -77,31 +112,40 @@ async def submit_invoice_for_extraction(
         )
 
     try:
-        # 2. Read raw file content
-        file_content_bytes = await file.read()
-        if not file_content_bytes:
+        # 2. Read raw file content in chunks into a single buffer,
+        #    rejecting oversized uploads before they are fully buffered
+        too_large = HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"File exceeds the maximum upload size of {MAX_UPLOAD_SIZE} bytes.",
+        )
+        if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+            raise too_large
+        file_content = bytearray()
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            file_content += chunk
+            if len(file_content) > MAX_UPLOAD_SIZE:
+                raise too_large
+        if not file_content:
              raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="Received empty file.",
             )
 
-        # 3. Encode content for storage in Redis (JSON compatible)
-        file_content_b64 = base64.b64encode(file_content_bytes).decode('utf-8')
-
-        # 4. Generate Task ID and store task data in Redis
+        # 3. Generate Task ID and store task data in Redis
         task_id = str(uuid.uuid4())
         task_key = f"task:{task_id}"
-        task_data = {
-            "status": "PENDING",
-            "original_filename": file.filename,
-            "content_type": file.content_type, # Store original content type
-            "file_content_b64": file_content_b64, # Store base64 encoded content
-            "result": None,
-            "error": None
-        }
-
-        # Store as JSON string in Redis
-        redis_client.set(task_key, json.dumps(task_data))
+        task_record = TaskRecord(
+            status="PENDING",
+            original_filename=file.filename or "",
+            content_type=file.content_type, # Store original content type
+        )
+
+        # Store compressed file bytes under their own key, metadata as a Redis hash
+        redis_client.set(f"{task_key}:blob", zstd_compressor.compress(file_content))
+        # Unset fields are omitted from the hash; absent 'result'/'error' mean None
+        redis_client.hset(task_key, mapping=msgspec.to_builtins(task_record))
+        # Enqueue for the worker only once the task data is in place
+        redis_client.rpush(TASK_QUEUE_KEY, task_id)
 
         logging.info(f"Task {task_id} created and stored in Redis for file: {file.filename}")
 
@@ -128,22 +172,63 @@ async def get_task_status(task_id: str = Path(...)):
         raise HTTPException(status_code=503, detail="Service Unavailable: Cannot connect to Redis.")
 
     task_key = f"task:{task_id}"
-    task_data_json = redis_client.get(task_key)
+    task_status, result_json, error = redis_client.hmget(task_key, "status", "result", "error")
 
-    if not task_data_json:
+    if not task_status:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Task not found")
 
     try:
-        task_data = json.loads(task_data_json)
-        # Remove sensitive file content before returning status to client
-        task_data.pop("file_content_b64", None)
-        task_data.pop("content_type", None) # Optionally remove content_type too
+        body = build_task_status_body(task_status, result_json, error)
+        return Response(content=body, media_type="application/json")
 
-        return TaskStatus(**task_data)
-
-    except json.JSONDecodeError:
-         logging.error(f"Failed to decode JSON data for task {task_id} from Redis.")
-         raise HTTPException(status_code=500, detail="Internal server error: Invalid task data.")
     except Exception as e:
         logging.error(f"Error retrieving task {task_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Internal server error retrieving task status.")
+
+@app.websocket("/tasks/{task_id}/ws")
+async def stream_task_status(websocket: WebSocket, task_id: str):
+    """
+    Connect to this WebSocket to receive the task status whenever it changes,
+    instead of polling. The connection is closed once the task has finished.
+    """
+    await websocket.accept()
+
+    task_key = f"task:{task_id}"
+    pubsub = async_redis_client.pubsub()
+    try:
+        # Subscribe before reading the current status so no update is missed in between
+        await pubsub.subscribe(f"{task_key}:events")
+
+        task_status, result_json, error = await async_redis_client.hmget(task_key, "status", "result", "error")
+        if not task_status:
+            await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Task not found")
+            return
+        await websocket.send_text(build_task_status_body(task_status, result_json, error).decode())
+
+        # Watch the client side too, so a disconnect ends the handler (and frees its
+        # pub/sub connection) even if the task never changes state again
+        disconnect_watcher = asyncio.create_task(wait_for_disconnect(websocket))
+        try:
+            while task_status not in FINAL_TASK_STATUSES:
+                next_event = asyncio.ensure_future(pubsub.get_message(ignore_subscribe_messages=True, timeout=None))
+                await asyncio.wait({next_event, disconnect_watcher}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnect_watcher.done():
+                    next_event.cancel()
+                    raise WebSocketDisconnect()
+                if next_event.result() is None:
+                    continue
+                # The event only signals a change; the hash holds the current state
+                task_status, result_json, error = await async_redis_client.hmget(task_key, "status", "result", "error")
+                await websocket.send_text(build_task_status_body(task_status, result_json, error).decode())
+        finally:
+            disconnect_watcher.cancel()
+
+        await websocket.close()
+
+    except WebSocketDisconnect:
+        logging.info(f"Client disconnected from status updates for task {task_id}")
+    except redis.exceptions.ConnectionError as e:
+        logging.error(f"Redis error streaming status for task {task_id}: {e}")
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR, reason="Cannot connect to Redis.")
+    finally:
+        await pubsub.aclose()
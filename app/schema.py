@@ -1,6 +1,17 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Any, Dict, List, Optional, Union
-import json # Needed for generating the schema string later
+import orjson # Needed for generating the schema string later
+import msgspec
+
+# --- Internal Task Record ---
+
+class TaskRecord(msgspec.Struct, omit_defaults=True):
+    """Internal task metadata shared by API and worker, stored as a Redis hash."""
+    status: str
+    original_filename: str = ""
+    content_type: str = ""
+    result: Optional[str] = None # JSON-encoded extraction result
+    error: Optional[str] = None
 
 # --- Nested Models ---
 
@@ -52,10 +63,10 @@ class GeneralizedInvoiceData(BaseModel):
     # Add catch-all dictionary
     other_data: Optional[Dict[str, Any]] = Field(None, description="Any other relevant line item details not covered by specific fields (e.g., SKU, specific tax/discount info, product code).")
     
-    class Config:
+    model_config = ConfigDict(
         # Example for generating schema documentation if needed
         # This helps understand the structure but isn't strictly required for validation
-        json_schema_extra = {
+        json_schema_extra={
             "example": {
                 "invoice_number": "123100401",
                 "invoice_date": "1. März 2024",
@@ -113,8 +124,11 @@ class GeneralizedInvoiceData(BaseModel):
                 "order_number": None,
                 "payment_terms_or_notes": "Terms of Payment: Immediate payment without discount. Any bank charges must be paid by the invoice recipient.\nPlease credit the amount invoiced to IBAN DE29 1234 5678 9012 3456 78 | BIC GENODE51MIC (SEPA Credit Transfer)"
             }
-        }
+        },
+    )
+
+# The schema is constant, so generate its JSON string once at import
+_SCHEMA_JSON = orjson.dumps(GeneralizedInvoiceData.model_json_schema(), option=orjson.OPT_INDENT_2).decode()
 
 def get_invoice_schema_json_string():
-    schema_json_string = json.dumps(GeneralizedInvoiceData.model_json_schema(), indent=2)
-    return schema_json_string
+    return _SCHEMA_JSON
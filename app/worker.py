@@ -1,14 +1,19 @@
 import os
-import io        # Import io
-import json
 import logging
-import time
-import base64    # Import base64
+import asyncio
+import uvloop
+import threading
 from typing import Dict, Optional
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
 import redis
-import PyPDF2    # Import PyPDF2
+from redis.asyncio import Redis
+import orjson
+import msgspec
+import tiktoken
+import zstandard
+import pypdfium2 # PDFium bindings for fast PDF text extraction
 
 # --- Configuration & Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,19 +22,31 @@ load_dotenv()
 REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
 REDIS_PORT = 6379
 REDIS_DB = 0
-WORKER_POLL_INTERVAL = 1
+TASK_QUEUE_KEY = "queue:pending"
+LLM_MAX_INPUT_TOKENS = int(os.environ.get("LLM_MAX_INPUT_TOKENS", 2000)) # Document text budget per LLM call
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 8)) # Max tasks processed at once
 
 # --- Schema Import ---
 try:
-    from schema import GeneralizedInvoiceData, get_invoice_schema_json_string
+    from schema import GeneralizedInvoiceData, TaskRecord, get_invoice_schema_json_string
 except ImportError:
     logging.error("Could not import from schema.py.")
     class GeneralizedInvoiceData: pass
+    class TaskRecord: pass
     def get_invoice_schema_json_string(): return "{}"
 
 # --- OpenAI Client Initialization ---
 try:
-    openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    # Keep-alive HTTP/2 pool sized for concurrent tasks, so LLM calls reuse connections
+    openai_http_client = DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=WORKER_CONCURRENCY * 2,
+            max_connections=WORKER_CONCURRENCY * 4,
+        ),
+        timeout=60,
+    )
+    openai_client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), http_client=openai_http_client)
     if not os.environ.get("OPENAI_API_KEY"):
         logging.warning("OPENAI_API_KEY environment variable not set or empty.")
         openai_client = None
@@ -38,60 +55,89 @@ except Exception as e:
     logging.error(f"Error initializing OpenAI client: {e}")
     openai_client = None
 
-# --- Redis Connection ---
+# --- Tokenizer Initialization (o200k_base is the gpt-4o encoding) ---
+# The encoding file is baked into the image via TIKTOKEN_CACHE_DIR (see Dockerfile).
+# Fail at startup if it cannot be loaded rather than silently changing the input budget.
 try:
-    redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
-    redis_client.ping()
-    logging.info(f"Worker successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
-except redis.exceptions.ConnectionError as e:
-    logging.error(f"Worker failed to connect to Redis at {REDIS_HOST}:{REDIS_PORT}: {e}")
-    redis_client = None
+    token_encoding = tiktoken.get_encoding("o200k_base")
+except Exception as e:
+    logging.error(f"Failed to load tokenizer 'o200k_base': {e}")
+    raise
+
+# --- Redis Connection (async clients connect lazily; checked in main_loop) ---
+# Values are kept as bytes end-to-end; JSON and file content need no UTF-8 round trip
+redis_client = Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=False)
 
 # --- Helper Functions (File Reading - Moved here) ---
-def read_pdf(file_stream: io.BytesIO) -> str:
-    """Reads text content from a PDF file stream."""
+# PDFium is not thread-safe, so concurrent tasks must take turns parsing PDFs
+_PDFIUM_LOCK = threading.Lock()
+
+def read_pdf(file_content: bytes) -> str:
+    """Reads text content from raw PDF bytes."""
     try:
-        reader = PyPDF2.PdfReader(file_stream)
-        text = ""
-        for page in reader.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text += page_text + "\n"
-        return text
+        with _PDFIUM_LOCK:
+            # PDFium reads straight from the bytes buffer, no stream wrapper needed
+            pdf = pypdfium2.PdfDocument(file_content)
+            try:
+                page_texts = []
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    page_texts.append(textpage.get_text_bounded())
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+        return "".join(page_text + "\n" for page_text in page_texts if page_text)
     except Exception as e:
         # Log specific error during PDF reading
-        logging.error(f"PyPDF2 error reading PDF stream: {e}", exc_info=True)
+        logging.error(f"PDFium error reading PDF content: {e}", exc_info=True)
         # Re-raise a more specific error for the worker to catch
         raise ValueError(f"Failed to read PDF content: {e}")
 
-def read_txt(file_stream: io.BytesIO) -> str:
-    """Reads text content from a TXT file stream."""
+def read_txt(file_content: bytes) -> str:
+    """Reads text content from raw TXT bytes."""
     try:
         # Attempt common encodings if utf-8 fails
         try:
-            return file_stream.read().decode("utf-8")
+            return file_content.decode("utf-8")
         except UnicodeDecodeError:
             logging.warning("UTF-8 decoding failed, trying latin-1.")
-            file_stream.seek(0) # Reset stream position
-            return file_stream.read().decode("latin-1")
+            return file_content.decode("latin-1")
     except Exception as e:
-        logging.error(f"Error reading TXT stream: {e}", exc_info=True)
+        logging.error(f"Error reading TXT content: {e}", exc_info=True)
         raise ValueError(f"Failed to read TXT content: {e}")
 
-# --- LLM Extraction Logic (Remains the same) ---
-def extract_invoice_data_with_llm(document_text: str) -> Dict:
-    """Uses an LLM to extract structured data from document text."""
-    # ... (Keep the existing LLM call logic exactly as it was) ...
-    if not openai_client:
-         logging.error("LLM client is not configured (API key missing?). Cannot process request.")
-         # Raise an error here so the task is marked FAILED
-         raise ConnectionError("LLM client not available")
-
-    json_schema_string = get_invoice_schema_json_string()
-   
-    # --- LLM Prompt Engineering ---
-    # Ensure the schema string is correctly inserted
-    prompt = f"""
+def extract_text(compressed_content: bytes, content_type: str) -> str:
+    """Decompresses stored file content and extracts its text, truncated to the LLM input budget."""
+    # Module-level decompress uses a fresh context, so concurrent worker threads are safe
+    file_content = zstandard.decompress(compressed_content)
+    if content_type == 'application/pdf':
+        document_text = read_pdf(file_content)
+    elif content_type == 'text/plain':
+        document_text = read_txt(file_content)
+    else:
+        # Should not happen if API validates, but handle defensively
+        raise ValueError(f"Unsupported content_type '{content_type}' found in task data.")
+    # Tokenizing is CPU-bound too, so truncate here rather than on the event loop
+    return truncate_document_text(document_text)
+
+def truncate_document_text(document_text: str) -> str:
+    """Truncates document text to the LLM input token budget, copying only when needed."""
+    # Tokens rarely span more than 8 characters, so tokenizing a bounded prefix
+    # fills the budget without encoding the whole of a large document
+    max_chars = LLM_MAX_INPUT_TOKENS * 8
+    if len(document_text) > max_chars:
+        document_text = document_text[:max_chars]
+
+    token_ids = token_encoding.encode_ordinary(document_text)
+    if len(token_ids) <= LLM_MAX_INPUT_TOKENS:
+        return document_text
+    return token_encoding.decode(token_ids[:LLM_MAX_INPUT_TOKENS])
+
+# --- LLM Prompt Template (built once; only the document text varies per task) ---
+# The schema is baked in here, so each call only does a single %s substitution
+# (literal '%' in the schema, e.g. "19 %", must be escaped as '%%')
+_PROMPT_TMPL = f"""
     You are an expert AI assistant specializing in extracting structured data from invoice documents, regardless of language (e.g., English, German).
 
     Your task is to analyze the provided invoice text and extract relevant information according to the JSON schema defined below.
@@ -109,17 +155,29 @@ def extract_invoice_data_with_llm(document_text: str) -> Dict:
 
     **Target JSON Schema:**
     ```json
-    {json_schema_string}
+    {get_invoice_schema_json_string().replace("%", "%%")}
     ```
 
     Invoice Text to Analyze:
-    {document_text[:8000]}
+    %s
 
     JSON Output:
     """
+
+# --- LLM Extraction Logic (Remains the same) ---
+async def extract_invoice_data_with_llm(document_text: str) -> Dict:
+    """Uses an LLM to extract structured data from document text."""
+    # ... (Keep the existing LLM call logic exactly as it was) ...
+    if not openai_client:
+         logging.error("LLM client is not configured (API key missing?). Cannot process request.")
+         # Raise an error here so the task is marked FAILED
+         raise ConnectionError("LLM client not available")
+
+    # document_text is already truncated to the input budget by extract_text
+    prompt = _PROMPT_TMPL % document_text
     try:
         logging.info(f"Sending request to LLM model: {LLM_MODEL}")
-        response = openai_client.chat.completions.create(
+        response = await openai_client.chat.completions.create(
             model=LLM_MODEL,
             response_format={ "type": "json_object" },
             messages=[
@@ -130,10 +188,10 @@ def extract_invoice_data_with_llm(document_text: str) -> Dict:
         )
         json_string = response.choices[0].message.content
         logging.info("Received response from LLM.")
-        extracted_data = json.loads(json_string)
+        extracted_data = orjson.loads(json_string)
         return extracted_data
 
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         # Log the raw content that failed parsing
         raw_content = "N/A"
         try:
@@ -147,46 +205,33 @@ def extract_invoice_data_with_llm(document_text: str) -> Dict:
 
 
 # --- Worker Processing Logic ---
-def process_task(task_id: str, task_data: Dict):
+async def process_task(task_id: str, task_record: TaskRecord):
     """Processes a single task retrieved from Redis."""
     task_key = f"task:{task_id}"
-    original_filename = task_data.get("original_filename", "N/A")
+    original_filename = task_record.original_filename or "N/A"
     logging.info(f"Processing task {task_id} for file: {original_filename}")
 
     file_text = None # Initialize file_text
 
     try:
-        # 1. Update status to PROCESSING
-        task_data["status"] = "PROCESSING"
-        # Remove file content before updating status to avoid storing it longer than needed
-        # We keep it in the local task_data dict for this function's scope
-        redis_task_update = task_data.copy()
-        redis_task_update.pop("file_content_b64", None)
-        redis_client.set(task_key, json.dumps(redis_task_update))
-
-        # 2. Retrieve content type and decode file content
-        content_type = task_data.get("content_type")
-        file_content_b64 = task_data.get("file_content_b64")
-
-        if not content_type or not file_content_b64:
-            raise ValueError("Missing 'content_type' or 'file_content_b64' in task data.")
-
-        logging.debug(f"Task {task_id}: Decoding base64 content...")
-        file_content_bytes = base64.b64decode(file_content_b64)
-        file_stream = io.BytesIO(file_content_bytes)
-        logging.debug(f"Task {task_id}: Decoded {len(file_content_bytes)} bytes.")
-
-        # 3. Extract text based on content type
-        logging.info(f"Task {task_id}: Extracting text for type {content_type}...")
-        if content_type == 'application/pdf':
-            file_text = read_pdf(file_stream)
-        elif content_type == 'text/plain':
-            file_text = read_txt(file_stream)
-        else:
-            # Should not happen if API validates, but handle defensively
-            raise ValueError(f"Unsupported content_type '{content_type}' found in task data.")
+        # 1. Update status to PROCESSING and fetch raw file content in one round trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(task_key, "status", "PROCESSING")
+            pipe.publish(f"{task_key}:events", "PROCESSING")
+            pipe.get(f"{task_key}:blob")
+            _, _, file_content_bytes = await pipe.execute()
+
+        # 2. Retrieve content type
+        content_type = task_record.content_type
 
-        file_stream.close() # Close the stream
+        if not content_type or not file_content_bytes:
+            raise ValueError("Missing 'content_type' or file content for task.")
+
+        logging.debug(f"Task {task_id}: Loaded {len(file_content_bytes)} bytes.")
+
+        # 3. Decompress and extract text based on content type (CPU-bound, so off the event loop)
+        logging.info(f"Task {task_id}: Extracting text for type {content_type}...")
+        file_text = await asyncio.to_thread(extract_text, file_content_bytes, content_type)
 
         if not file_text or not file_text.strip():
             raise ValueError("No text could be extracted from the document.")
@@ -194,16 +239,17 @@ def process_task(task_id: str, task_data: Dict):
         logging.info(f"Task {task_id}: Text extracted successfully (length: {len(file_text)}).")
 
         # 4. Extract data using LLM
-        extracted_data_dict = extract_invoice_data_with_llm(file_text)
+        extracted_data_dict = await extract_invoice_data_with_llm(file_text)
 
         logging.info(f"Task {task_id}: LLM extraction successful.")
 
         # 5. Optional: Validate with Pydantic
         validated_result = None
         try:
-            # Use the raw dict from LLM for validation
-            validated_data = GeneralizedInvoiceData(**extracted_data_dict)
-            validated_result = validated_data.model_dump() # Get dict from Pydantic model
+            # Lax validation coerces values (e.g. "12.50" -> 12.5), so store the dumped
+            # model rather than the raw LLM dict to keep the result in the schema's types
+            validated_data = GeneralizedInvoiceData.model_validate(extracted_data_dict)
+            validated_result = validated_data.model_dump()
             logging.info(f"Task {task_id}: Pydantic validation successful.")
         except Exception as validation_error:
             # Log validation failure but proceed with raw data if needed, or fail task
@@ -213,78 +259,117 @@ def process_task(task_id: str, task_data: Dict):
             raise ValueError(f"Schema validation failed: {validation_error}")
 
         # 6. Update Redis with final status and result
-        task_data["status"] = "COMPLETED"
-        task_data["result"] = validated_result # Store the validated (or raw) dict
-        task_data["error"] = None
-        # Remove file content before final update
-        task_data.pop("file_content_b64", None)
-        redis_client.set(task_key, json.dumps(task_data))
+        # File content is no longer needed once the task is finished
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(task_key, mapping={
+                "status": "COMPLETED",
+                "result": orjson.dumps(validated_result), # Store the validated dict as JSON
+            })
+            pipe.delete(f"{task_key}:blob")
+            # Notify status subscribers only after the result is stored
+            pipe.publish(f"{task_key}:events", "COMPLETED")
+            await pipe.execute()
         logging.info(f"Task {task_id} completed successfully.")
 
     except Exception as e:
         logging.error(f"Error processing task {task_id}: {e}", exc_info=True)
         # Update status to FAILED in Redis
         try:
-            # Ensure task_data exists even if error happened early
-            if 'task_data' not in locals(): task_data = {}
-            task_data["status"] = "FAILED"
-            task_data["error"] = f"{type(e).__name__}: {str(e)}" # Store error type and message
-            task_data["result"] = None
-            # Remove potentially large file content before storing error state
-            task_data.pop("file_content_b64", None)
-            redis_client.set(task_key, json.dumps(task_data))
+            # Remove potentially large file content once the task has failed
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.hset(task_key, mapping={
+                    "status": "FAILED",
+                    "error": f"{type(e).__name__}: {str(e)}", # Store error type and message
+                })
+                pipe.hdel(task_key, "result")
+                pipe.delete(f"{task_key}:blob")
+                pipe.publish(f"{task_key}:events", "FAILED")
+                await pipe.execute()
             logging.info(f"Task {task_id} marked as FAILED.")
         except Exception as redis_err:
              logging.error(f"CRITICAL: Failed to update Redis status to FAILED for task {task_id}: {redis_err}")
 
 
-# --- Main Worker Loop (Using simple polling for now) ---
-def main_loop():
-    """Continuously checks Redis for pending tasks and processes them."""
-    if not redis_client:
-        logging.error("Worker cannot start: No connection to Redis.")
+# --- Main Worker Loop (Batched pops from the task queue, concurrent processing) ---
+async def _process_and_release(semaphore: asyncio.Semaphore, task_id: str, task_record: TaskRecord):
+    """Runs a task and frees its concurrency slot when done."""
+    try:
+        await process_task(task_id, task_record)
+    finally:
+        semaphore.release()
+
+async def main_loop():
+    """Blocks on the Redis task queue and processes up to WORKER_CONCURRENCY tasks at once."""
+    try:
+        await redis_client.ping()
+        logging.info(f"Worker successfully connected to Redis at {REDIS_HOST}:{REDIS_PORT}")
+    except redis.exceptions.ConnectionError as e:
+        logging.error(f"Worker cannot start: No connection to Redis at {REDIS_HOST}:{REDIS_PORT}: {e}")
         return
 
-    logging.info("Worker started. Waiting for tasks...")
+    semaphore = asyncio.Semaphore(WORKER_CONCURRENCY)
+    running_tasks = set() # Keep references so running tasks are not garbage collected
+
+    logging.info(f"Worker started (concurrency: {WORKER_CONCURRENCY}). Waiting for tasks...")
     while True:
-        task_to_process = None
-        task_id = None
+        # Only take tasks off the queue once there are free slots to process them.
+        # Wait for one slot, then claim any others that are free as well.
+        await semaphore.acquire()
+        slots = 1
+        while slots < WORKER_CONCURRENCY and not semaphore.locked():
+            await semaphore.acquire()
+            slots += 1
+        dispatched = 0
         try:
-            # Option A: Simple Polling (less efficient)
-            task_keys = redis_client.keys("task:*")
-            for task_key in task_keys:
-                task_data_json = redis_client.get(task_key)
-                if not task_data_json: continue
+            # Pop up to one task per free slot in a single round trip
+            task_ids = await redis_client.lpop(TASK_QUEUE_KEY, count=slots)
+            if not task_ids:
+                # Queue is empty: block server-side until a task ID is pushed by the API
+                _, task_id = await redis_client.blpop(TASK_QUEUE_KEY)
+                task_ids = [task_id]
+            task_ids = [task_id.decode() for task_id in task_ids]
+
+            # Fetch the task data for the whole batch in one round trip
+            async with redis_client.pipeline(transaction=False) as pipe:
+                for task_id in task_ids:
+                    pipe.hgetall(f"task:{task_id}")
+                batch_task_data = await pipe.execute()
+
+            for task_id, task_data in zip(task_ids, batch_task_data):
+                if not task_data:
+                    logging.error(f"Task data not found for queued task {task_id}")
+                    continue
                 try:
-                    task_data = json.loads(task_data_json)
-                    if task_data.get("status") == "PENDING":
-                        task_id = task_key.split(":", 1)[1]
-                        task_to_process = task_data
-                        break # Process one task per loop iteration
-                except (json.JSONDecodeError, IndexError):
-                    logging.error(f"Invalid data or key format for {task_key}")
-                    # Consider moving/deleting the bad key
-                except Exception as e:
-                    logging.error(f"Error checking task {task_key}: {e}")
-
-            # Process the found task (if any)
-            if task_to_process and task_id:
-                process_task(task_id, task_to_process)
-            else:
-                # No pending task found, wait before checking again
-                time.sleep(WORKER_POLL_INTERVAL)
+                    # Metadata fields are short, so decoding them for the typed record is cheap
+                    task_record = msgspec.convert(
+                        {field.decode(): value.decode() for field, value in task_data.items()},
+                        TaskRecord,
+                    )
+                except msgspec.ValidationError as e:
+                    logging.error(f"Invalid task data for task:{task_id}: {e}")
+                    continue
+
+                task = asyncio.create_task(_process_and_release(semaphore, task_id, task_record))
+                running_tasks.add(task)
+                task.add_done_callback(running_tasks.discard)
+                dispatched += 1
 
         except redis.exceptions.ConnectionError:
              logging.error("Redis connection lost. Attempting to reconnect...")
-             time.sleep(5)
+             await asyncio.sleep(5)
              try:
-                 redis_client.ping()
+                 await redis_client.ping()
                  logging.info("Reconnected to Redis.")
              except redis.exceptions.ConnectionError:
                  logging.error("Reconnect failed.")
         except Exception as e:
             logging.error(f"An unexpected error occurred in the main worker loop: {e}", exc_info=True)
-            time.sleep(5) # Wait before retrying loop
+            await asyncio.sleep(5) # Wait before retrying loop
+        finally:
+            # Give back the slots that did not get a task
+            for _ in range(slots - dispatched):
+                semaphore.release()
 
 if __name__ == "__main__":
-    main_loop()
\ No newline at end of file
+    # libuv-based event loop; cheaper per Redis/OpenAI socket operation than asyncio's default
+    uvloop.run(main_loop())